@@ -15,6 +15,14 @@ app.conf.beat_schedule = {
         'task': 'ip_tracking.tasks.detect_anomalies',
         'schedule': crontab(minute=0),  # Every hour at minute 0
     },
+    'backfill-request-log-geolocation': {
+        'task': 'ip_tracking.tasks.backfill_request_log_geolocation',
+        'schedule': crontab(minute='*/5'),  # Every 5 minutes
+    },
+    'maintain-request-log-partitions': {
+        'task': 'ip_tracking.tasks.maintain_request_log_partitions',
+        'schedule': crontab(hour=1, minute=0),  # Daily at 1:00 AM
+    },
     'cleanup-old-suspicious-records': {
         'task': 'ip_tracking.tasks.cleanup_old_suspicious_records',
         'schedule': crontab(hour=2, minute=0),  # Daily at 2:00 AM
@@ -0,0 +1,14 @@
+from django.apps import AppConfig
+
+
+class IpTrackingConfig(AppConfig):
+    default_auto_field = 'django.db.models.BigAutoField'
+    name = 'ip_tracking'
+
+    def ready(self):
+        from . import blocklist, logqueue
+
+        # The filter itself is built lazily on first lookup, since querying
+        # the database from ready() is unsafe before migrations have run.
+        blocklist.connect_signals()
+        logqueue.install_shutdown_hooks()
@@ -0,0 +1,222 @@
+"""
+Process-local blocklist used by IPTrackingMiddleware.
+
+Lookups go through four tiers so the common case (an IP that is not
+blocked, or a blocked IP hammering us) never leaves the process:
+
+1. A short-lived per-IP decision cache answers repeat requests.
+2. A Bloom filter built from BlockedIP answers "definitely not blocked".
+3. On a Bloom "maybe", the shared Redis set ``blocked_ips`` confirms a hit.
+4. Anything Redis cannot confirm (false positive, eviction, outage) is
+   settled by the database.
+
+The filter is built on first use and rebuilt from the database every
+BLOCKLIST_REFRESH_INTERVAL seconds, in a background thread, so IPs blocked
+from other processes (Celery auto-blocking, the block_ip command) reach
+every web worker without stalling requests. Installing a rebuilt filter
+also drops cached "not blocked" decisions, so such a block takes effect
+within one refresh interval rather than waiting out the decision TTL.
+"""
+import hashlib
+import logging
+import math
+import threading
+import time
+
+from cachetools import TTLCache
+from django.conf import settings
+from django.db import DatabaseError, connection
+from django.db.models.signals import post_delete, post_save
+from redis.exceptions import RedisError
+
+from .connections import get_redis_client
+from .models import BlockedIP
+
+logger = logging.getLogger('ip_tracking')
+
+REDIS_KEY = 'blocked_ips'
+
+
+class BloomFilter:
+    """Fixed-size Bloom filter using double hashing over a blake2b digest."""
+
+    def __init__(self, capacity, error_rate=0.001):
+        capacity = max(capacity, 1)
+        self.size = max(8, int(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.hash_count = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, item):
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hash_count))
+
+    def add(self, item):
+        for pos in self._positions(item):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, item):
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(item))
+
+
+def _setting(name, default):
+    return getattr(settings, 'IP_TRACKING', {}).get(name, default)
+
+
+_lock = threading.Lock()
+# Serialises the initial build so concurrent first requests load it only once
+_initial_load_lock = threading.Lock()
+_bloom = None
+_loaded_at = 0.0
+# IPs passed to add() while a rebuild is running; its SELECT may predate them
+_rebuilds_running = 0
+_added_during_rebuild = set()
+# ip -> bool, so bursts from one IP skip the Bloom/Redis/DB path entirely
+_decisions = TTLCache(
+    maxsize=_setting('BLOCKLIST_DECISION_CACHE_SIZE', 50000),
+    ttl=_setting('BLOCKLIST_DECISION_CACHE_TTL', 60),
+)
+
+
+def load(sync_redis=True):
+    """(Re)build the Bloom filter from BlockedIP and optionally reseed Redis."""
+    global _bloom, _loaded_at, _rebuilds_running
+
+    with _lock:
+        _rebuilds_running += 1
+    try:
+        ips = list(BlockedIP.objects.values_list('ip_address', flat=True))
+    except DatabaseError:
+        # Tables may not exist yet (e.g. before the first migrate)
+        logger.warning("Blocklist not loaded: BlockedIP table is unavailable")
+        with _lock:
+            _finish_rebuild()
+        return
+
+    bloom = BloomFilter(
+        max(len(ips) * 2, _setting('BLOCKLIST_CAPACITY', 10000)),
+        _setting('BLOCKLIST_ERROR_RATE', 0.001),
+    )
+    for ip in ips:
+        bloom.add(ip)
+
+    with _lock:
+        for ip in _added_during_rebuild:
+            bloom.add(ip)
+        _finish_rebuild()
+        _bloom = bloom
+        _loaded_at = time.monotonic()
+        # Negative decisions were made against the old filter
+        for ip, decision in list(_decisions.items()):
+            if not decision:
+                _decisions.pop(ip, None)
+
+    if sync_redis and ips:
+        try:
+            pipe = get_redis_client().pipeline()
+            pipe.delete(REDIS_KEY)
+            pipe.sadd(REDIS_KEY, *ips)
+            pipe.execute()
+        except RedisError:
+            logger.warning("Could not seed Redis blocklist; falling back to database checks")
+
+
+def _finish_rebuild():
+    # Caller holds _lock
+    global _rebuilds_running
+    _rebuilds_running -= 1
+    if not _rebuilds_running:
+        _added_during_rebuild.clear()
+
+
+def add(ip_address):
+    """Record a newly blocked IP in the local filter and the shared Redis set."""
+    with _lock:
+        if _bloom is not None:
+            _bloom.add(ip_address)
+        if _rebuilds_running:
+            _added_during_rebuild.add(ip_address)
+        _decisions.pop(ip_address, None)
+    try:
+        get_redis_client().sadd(REDIS_KEY, ip_address)
+    except RedisError:
+        logger.warning(f"Could not add {ip_address} to Redis blocklist")
+
+
+def discard(ip_address):
+    """Remove an unblocked IP from Redis; the filter drops it on next rebuild."""
+    with _lock:
+        _decisions.pop(ip_address, None)
+    try:
+        get_redis_client().srem(REDIS_KEY, ip_address)
+    except RedisError:
+        logger.warning(f"Could not remove {ip_address} from Redis blocklist")
+
+
+def is_blocked(ip_address):
+    """Return True if the IP is blocked, reusing decisions made in the last minute."""
+    with _lock:
+        decision = _decisions.get(ip_address)
+    if decision is None:
+        decision = _lookup(ip_address)
+        with _lock:
+            _decisions[ip_address] = decision
+    return decision
+
+
+def _refresh():
+    try:
+        load(sync_redis=False)
+    finally:
+        # Background threads get their own connection; don't leak it
+        connection.close()
+
+
+def _maybe_refresh():
+    """Build the filter on first use, then rebuild it off the request path when stale."""
+    global _loaded_at
+
+    if _bloom is None:
+        with _initial_load_lock:
+            if _bloom is None:
+                load()
+        return
+
+    now = time.monotonic()
+    with _lock:
+        if now - _loaded_at <= _setting('BLOCKLIST_REFRESH_INTERVAL', 30):
+            return
+        # Claim this refresh so concurrent requests keep using the current filter
+        _loaded_at = now
+    threading.Thread(target=_refresh, name='blocklist-refresh', daemon=True).start()
+
+
+def _lookup(ip_address):
+    """Resolve a block decision, touching Redis/DB only on a Bloom hit."""
+    _maybe_refresh()
+
+    bloom = _bloom
+    if bloom is not None and ip_address not in bloom:
+        return False
+
+    try:
+        if get_redis_client().sismember(REDIS_KEY, ip_address):
+            return True
+    except RedisError:
+        pass
+
+    return BlockedIP.objects.filter(ip_address=ip_address).exists()
+
+
+def _on_blocked_ip_saved(sender, instance, **kwargs):
+    add(instance.ip_address)
+
+
+def _on_blocked_ip_deleted(sender, instance, **kwargs):
+    discard(instance.ip_address)
+
+
+def connect_signals():
+    post_save.connect(_on_blocked_ip_saved, sender=BlockedIP, dispatch_uid='blocklist_add')
+    post_delete.connect(_on_blocked_ip_deleted, sender=BlockedIP, dispatch_uid='blocklist_discard')
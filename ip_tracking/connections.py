@@ -0,0 +1,16 @@
+from django.conf import settings
+import redis
+
+_client = None
+
+def get_redis_client():
+    """Return a process-wide Redis client built from IP_TRACKING['REDIS_URL']."""
+    global _client
+    if _client is None:
+        ip_settings = getattr(settings, 'IP_TRACKING', {})
+        _client = redis.Redis.from_url(
+            ip_settings.get('REDIS_URL', 'redis://localhost:6379/0'),
+            socket_timeout=ip_settings.get('REDIS_TIMEOUT', 0.5),
+            socket_connect_timeout=ip_settings.get('REDIS_TIMEOUT', 0.5),
+        )
+    return _client
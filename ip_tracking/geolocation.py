@@ -0,0 +1,147 @@
+from django.core.cache import cache
+from cachetools import TTLCache
+from redis.exceptions import RedisError
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import ipaddress
+import logging
+import requests
+import threading
+
+from .connections import get_redis_client
+
+logger = logging.getLogger('ip_tracking')
+
+CACHE_TIMEOUT = 86400  # 24 hours
+FAILURE_CACHE_TIMEOUT = 3600  # Cache failures for 1 hour only
+LOCK_TIMEOUT = 300  # seconds a pending lookup suppresses duplicate tasks
+REQUEST_TIMEOUT = (1, 3)  # (connect, read) seconds
+
+# Shared session so lookups reuse warm TCP/TLS connections to ipinfo.io
+_session = requests.Session()
+_session.mount('https://', HTTPAdapter(
+    pool_connections=10,
+    pool_maxsize=50,
+    max_retries=Retry(total=2, backoff_factor=0.2)
+))
+
+# Process-local L1 in front of the shared cache so repeat visitors skip the
+# cache round-trip; TTLCache is not thread-safe, hence the lock.
+_local_cache = TTLCache(maxsize=100000, ttl=3600)
+_local_cache_lock = threading.Lock()
+
+# Ranges that never resolve to a public location: RFC 1918, loopback,
+# link-local, RFC 6598 carrier-grade NAT, IPv6 loopback, unique-local and link-local
+PRIVATE_NETWORKS = tuple(ipaddress.ip_network(net) for net in (
+    '10.0.0.0/8',
+    '172.16.0.0/12',
+    '192.168.0.0/16',
+    '127.0.0.0/8',
+    '169.254.0.0/16',
+    '100.64.0.0/10',
+    '::1/128',
+    'fc00::/7',
+    'fe80::/10',
+))
+
+
+# Compact integer encoding of country values for RequestLog.country_code:
+# 0 = Unknown, 1 = Local, 2..677 = ISO 3166-1 alpha-2 codes (AA..ZZ),
+# -1 = any other value (never treated as a common country)
+COUNTRY_CODE_OTHER = -1
+COUNTRY_CODE_UNKNOWN = 0
+COUNTRY_CODE_LOCAL = 1
+
+
+def country_code(country):
+    """Encode a country value as a small integer; None stays None (not yet resolved)."""
+    if country is None:
+        return None
+    if country == 'Unknown':
+        return COUNTRY_CODE_UNKNOWN
+    if country == 'Local':
+        return COUNTRY_CODE_LOCAL
+    if len(country) == 2 and 'A' <= country[0] <= 'Z' and 'A' <= country[1] <= 'Z':
+        return 2 + (ord(country[0]) - 65) * 26 + (ord(country[1]) - 65)
+    return COUNTRY_CODE_OTHER
+
+
+def is_private_ip(ip_address):
+    """Return True for local/private addresses (and unparseable values such as 'localhost')."""
+    try:
+        address = ipaddress.ip_address(ip_address)
+    except ValueError:
+        return True
+    # Test IPv4-mapped IPv6 addresses (::ffff:10.0.0.1) against the IPv4 ranges
+    if address.version == 6 and address.ipv4_mapped is not None:
+        address = address.ipv4_mapped
+    return any(address in network for network in PRIVATE_NETWORKS)
+
+
+def get_cached_geolocation(ip_address):
+    """Return cached geolocation data for an IP, or None without calling the lookup service."""
+    with _local_cache_lock:
+        geo_data = _local_cache.get(ip_address)
+    if geo_data is not None:
+        return geo_data
+
+    try:
+        geo_data = cache.get(f"geolocation_{ip_address}")
+    except RedisError:
+        # The shared cache is Redis; treat an outage as a miss rather than fail the request
+        return None
+    if geo_data:
+        with _local_cache_lock:
+            _local_cache[ip_address] = geo_data
+    return geo_data
+
+
+def acquire_lookup_lock(ip_address):
+    """Return True if the caller should schedule a lookup for this IP (SETNX semantics)."""
+    # Taken directly in Redis so the lock is shared by every web worker
+    try:
+        return bool(get_redis_client().set(f"geo_lock:{ip_address}", 1, nx=True, ex=LOCK_TIMEOUT))
+    except RedisError:
+        return False
+
+
+def _cache_result(cache_key, geo_data, timeout):
+    try:
+        cache.set(cache_key, geo_data, timeout)
+    except RedisError:
+        logger.warning(f"Could not cache geolocation for {cache_key}")
+
+
+def get_geolocation(ip_address):
+    """Get geolocation data for an IP address with caching."""
+    # Check cache first (24-hour cache)
+    cache_key = f"geolocation_{ip_address}"
+    cached_data = get_cached_geolocation(ip_address)
+    if cached_data:
+        return cached_data
+
+    # Skip geolocation for local/private IPs
+    if is_private_ip(ip_address):
+        geo_data = {'country': 'Local', 'city': 'Local'}
+        _cache_result(cache_key, geo_data, CACHE_TIMEOUT)
+        return geo_data
+
+    try:
+        # Using ipinfo.io API (free tier allows 50,000 requests/month)
+        response = _session.get(f'https://ipinfo.io/{ip_address}/json', timeout=REQUEST_TIMEOUT)
+        if response.status_code == 200:
+            data = response.json()
+            geo_data = {
+                'country': data.get('country', 'Unknown'),
+                'city': data.get('city', 'Unknown')
+            }
+            _cache_result(cache_key, geo_data, CACHE_TIMEOUT)
+            return geo_data
+    except requests.RequestException:
+        # Handle network errors gracefully
+        pass
+
+    # Default fallback
+    geo_data = {'country': 'Unknown', 'city': 'Unknown'}
+    _cache_result(cache_key, geo_data, FAILURE_CACHE_TIMEOUT)
+    return geo_data
@@ -0,0 +1,106 @@
+"""
+Buffered RequestLog writer.
+
+IPTrackingMiddleware hands unsaved RequestLog instances to put(); a
+background thread drains them in batches and writes each batch with a
+single bulk_create inside one transaction, keeping the INSERT off the
+request path. A batch that fails is split in halves and retried, so one
+bad row cannot discard the rows queued alongside it.
+"""
+import atexit
+import logging
+import queue
+import threading
+
+from django.conf import settings
+from django.db import DatabaseError, close_old_connections, transaction
+
+from .models import RequestLog
+
+logger = logging.getLogger('ip_tracking')
+
+_settings = getattr(settings, 'IP_TRACKING', {})
+BATCH_SIZE = _settings.get('LOG_BATCH_SIZE', 500)
+FLUSH_INTERVAL = _settings.get('LOG_FLUSH_INTERVAL', 1.0)  # seconds
+
+_queue = queue.Queue(maxsize=_settings.get('LOG_QUEUE_SIZE', 10000))
+_thread = None
+_thread_lock = threading.Lock()
+
+
+def put(request_log):
+    """Queue an unsaved RequestLog for the next batch write."""
+    _ensure_started()
+    try:
+        _queue.put_nowait(request_log)
+    except queue.Full:
+        # Writer has fallen behind; write synchronously rather than drop the row
+        logger.warning("Request log queue full, writing log entry synchronously")
+        request_log.save()
+
+
+def _drain(block):
+    """Pull up to BATCH_SIZE items, waiting up to FLUSH_INTERVAL for the first."""
+    batch = []
+    try:
+        batch.append(_queue.get(timeout=FLUSH_INTERVAL) if block else _queue.get_nowait())
+        while len(batch) < BATCH_SIZE:
+            batch.append(_queue.get_nowait())
+    except queue.Empty:
+        pass
+    return batch
+
+
+def _write(batch):
+    close_old_connections()
+    _write_or_split(batch)
+
+
+def _write_or_split(batch):
+    """Insert the batch; on failure split it in halves so a bad row drops only itself."""
+    try:
+        with transaction.atomic():
+            RequestLog.objects.bulk_create(batch, batch_size=BATCH_SIZE)
+    except DatabaseError:
+        if len(batch) == 1:
+            logger.exception(f"Dropped request log entry for {batch[0].ip_address}")
+            return
+        middle = len(batch) // 2
+        _write_or_split(batch[:middle])
+        _write_or_split(batch[middle:])
+
+
+def _run():
+    while True:
+        batch = _drain(block=True)
+        if batch:
+            _write(batch)
+
+
+def _ensure_started():
+    # Threads do not survive fork(), so pre-forking servers get a fresh
+    # writer in each worker on its first request.
+    global _thread
+    if _thread is not None and _thread.is_alive():
+        return
+    with _thread_lock:
+        if _thread is None or not _thread.is_alive():
+            _thread = threading.Thread(target=_run, name='request-log-writer', daemon=True)
+            _thread.start()
+
+
+def flush():
+    """Synchronously write everything still queued."""
+    while True:
+        batch = _drain(block=False)
+        if not batch:
+            return
+        _write(batch)
+
+
+def install_shutdown_hooks():
+    """Flush pending rows on interpreter exit."""
+    # Deliberately no SIGTERM handler: flushing from a signal handler can
+    # deadlock on the queue's lock or close a connection mid-request.
+    # gunicorn and celery shut down through sys.exit(), which runs atexit.
+    atexit.register(flush)
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+from ip_tracking.geolocation import country_code
+from ip_tracking.models import RequestLog
+
+class Command(BaseCommand):
+    help = 'Fill in RequestLog.country_code for rows that have a country but no code'
+
+    def handle(self, *args, **options):
+        missing = RequestLog.objects.filter(country__isnull=False, country_code__isnull=True)
+        
+        # One UPDATE per distinct country value rather than per row
+        countries = list(missing.values_list('country', flat=True).order_by().distinct())
+        
+        updated = 0
+        for country in countries:
+            updated += missing.filter(country=country).update(country_code=country_code(country))
+        
+        self.stdout.write(
+            self.style.SUCCESS(f'Backfilled country_code on {updated} request logs')
+        )
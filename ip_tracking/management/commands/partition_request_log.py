@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.utils import timezone
+from ip_tracking import partitions
+
+class Command(BaseCommand):
+    help = 'Convert RequestLog into a table partitioned by day on timestamp (PostgreSQL only)'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--days-ahead',
+            type=int,
+            default=7,
+            help='Number of future daily partitions to create'
+        )
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'postgresql':
+            raise CommandError('RequestLog partitioning requires PostgreSQL')
+        
+        # Check if the table is already partitioned
+        if partitions.is_partitioned():
+            self.stdout.write(
+                self.style.WARNING(f'{partitions.TABLE} is already partitioned')
+            )
+            return
+        
+        with transaction.atomic():
+            partitions.convert_to_partitioned(timezone.now().date(), options['days_ahead'])
+        
+        self.stdout.write(
+            self.style.SUCCESS(f'Successfully partitioned {partitions.TABLE} by day')
+        )
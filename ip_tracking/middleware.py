@@ -1,72 +1,81 @@
+from django.conf import settings
 from django.http import HttpResponseForbidden
 from django.utils.deprecation import MiddlewareMixin
-from django.core.cache import cache
-from .models import RequestLog, BlockedIP
-import requests
-import json
+from kombu.exceptions import OperationalError
+from .models import RequestLog
+from . import blocklist, geolocation, logqueue
+from .tasks import enrich_geo
+import logging
+
+logger = logging.getLogger('ip_tracking')
+
+# Client-controlled values longer than the column would fail the whole batch insert
+PATH_MAX_LENGTH = RequestLog._meta.get_field('path').max_length
+PATH_PREFIX_MAX_LENGTH = RequestLog._meta.get_field('path_prefix').max_length
+
+# Reverse proxies whose X-Forwarded-For entries are trusted; empty ignores the header.
+# Defaults to loopback, which matches the documented local nginx deployment.
+TRUSTED_PROXIES = frozenset(getattr(settings, 'IP_TRACKING', {}).get('TRUSTED_PROXIES', ('127.0.0.1', '::1')))
 
 class IPTrackingMiddleware(MiddlewareMixin):
     def get_client_ip(self, request):
-        """Get the client's IP address, accounting for proxies."""
+        """
+        Get the client's IP address, accounting for trusted proxies.
+
+        Proxies append to X-Forwarded-For, so only the entries they added are
+        trustworthy: walk the header from the right and return the first hop
+        that is not one of our proxies. The leftmost entries are client-supplied.
+        """
+        remote_addr = request.META.get('REMOTE_ADDR')
         x_forwarded_for = request.META.get('HTTP_X_FORWARDED_FOR')
-        if x_forwarded_for:
-            ip = x_forwarded_for.split(',')[0]
-        else:
-            ip = request.META.get('REMOTE_ADDR')
-        return ip
+        if not x_forwarded_for or remote_addr not in TRUSTED_PROXIES:
+            return remote_addr
+
+        rest = x_forwarded_for
+        while rest:
+            rest, _, hop = rest.rpartition(',')
+            hop = hop.strip()
+            if hop and hop not in TRUSTED_PROXIES:
+                return hop
+        return remote_addr
 
     def get_geolocation(self, ip_address):
-        """Get geolocation data for an IP address with caching."""
-        # Check cache first (24-hour cache)
-        cache_key = f"geolocation_{ip_address}"
-        cached_data = cache.get(cache_key)
-        if cached_data:
-            return cached_data
+        """
+        Return cached geolocation data without blocking on the lookup service.
 
-        # Skip geolocation for local/private IPs
-        if ip_address in ['127.0.0.1', 'localhost'] or ip_address.startswith('192.168.') or ip_address.startswith('10.'):
-            geo_data = {'country': 'Local', 'city': 'Local'}
-            cache.set(cache_key, geo_data, 86400)  # Cache for 24 hours
+        On a cache miss an enrich_geo task is scheduled (at most one per IP at a
+        time) and an empty result is returned; the task backfills the log rows.
+        """
+        geo_data = geolocation.get_cached_geolocation(ip_address)
+        if geo_data:
             return geo_data
 
-        try:
-            # Using ipinfo.io API (free tier allows 50,000 requests/month)
-            response = requests.get(f'http://ipinfo.io/{ip_address}/json', timeout=5)
-            if response.status_code == 200:
-                data = response.json()
-                geo_data = {
-                    'country': data.get('country', 'Unknown'),
-                    'city': data.get('city', 'Unknown')
-                }
-                # Cache for 24 hours (86400 seconds)
-                cache.set(cache_key, geo_data, 86400)
-                return geo_data
-        except requests.RequestException:
-            # Handle network errors gracefully
-            pass
-
-        # Default fallback
-        geo_data = {'country': 'Unknown', 'city': 'Unknown'}
-        cache.set(cache_key, geo_data, 3600)  # Cache failures for 1 hour only
-        return geo_data
+        if geolocation.acquire_lookup_lock(ip_address):
+            try:
+                enrich_geo.delay(ip_address)
+            except OperationalError:
+                logger.warning(f"Could not schedule geolocation lookup for {ip_address}")
+        return {}
 
     def process_request(self, request):
         # Get client IP address
         ip_address = self.get_client_ip(request)
         
         # Check if IP is blacklisted
-        if BlockedIP.objects.filter(ip_address=ip_address).exists():
+        if blocklist.is_blocked(ip_address):
             return HttpResponseForbidden("Access denied: Your IP address has been blocked.")
         
-        # Get geolocation data
+        # Get geolocation data (cache only; lookups happen in Celery)
         geo_data = self.get_geolocation(ip_address)
         
-        # Log the request with geolocation data
-        RequestLog.objects.create(
+        # Queue the log entry; it is written in batches off the request path
+        logqueue.put(RequestLog(
             ip_address=ip_address,
-            path=request.path,
+            path=request.path[:PATH_MAX_LENGTH],
+            path_prefix=(request.path.rstrip('/') or '/')[:PATH_PREFIX_MAX_LENGTH],
             country=geo_data.get('country'),
+            country_code=geolocation.country_code(geo_data.get('country')),
             city=geo_data.get('city')
-        )
+        ))
         
         return None
@@ -5,11 +5,19 @@ class RequestLog(models.Model):
     ip_address = models.GenericIPAddressField()
     timestamp = models.DateTimeField(default=timezone.now)
     path = models.CharField(max_length=500)
+    # Path normalised without a trailing slash, used for sensitive-path matching
+    path_prefix = models.CharField(max_length=500, blank=True, default='')
     country = models.CharField(max_length=100, blank=True, null=True)
+    # Integer form of country (see geolocation.country_code) for cheap comparisons
+    country_code = models.SmallIntegerField(blank=True, null=True)
     city = models.CharField(max_length=100, blank=True, null=True)
     
     class Meta:
         ordering = ['-timestamp']
+        indexes = [
+            models.Index(fields=['timestamp']),
+            models.Index(fields=['ip_address', 'timestamp']),
+        ]
     
     def __str__(self):
         location = f"{self.city}, {self.country}" if self.city and self.country else "Unknown"
@@ -34,6 +42,10 @@ class SuspiciousIP(models.Model):
     class Meta:
         ordering = ['-detected_at']
         unique_together = ['ip_address', 'reason', 'detected_at']
+        indexes = [
+            models.Index(fields=['detected_at']),
+            models.Index(fields=['ip_address', 'detected_at']),
+        ]
     
     def __str__(self):
         return f"{self.ip_address} - {self.reason} ({self.detected_at.strftime('%Y-%m-%d %H:%M')})"
@@ -0,0 +1,161 @@
+"""
+Daily range partitioning of RequestLog on PostgreSQL.
+
+Once the table has been converted (see the partition_request_log command),
+each UTC day lives in its own child table named
+``<db_table>_YYYY_MM_DD``. Time-range queries are pruned to the matching
+partitions and expired days are retired with DROP TABLE instead of DELETE.
+
+A DEFAULT partition catches rows for days whose partition does not exist
+yet (e.g. if maintenance stopped running), so inserts never fail. Those
+rows are moved into the proper partition when it is created.
+"""
+from datetime import datetime, timedelta
+
+from django.db import connection
+
+from .models import RequestLog
+
+TABLE = RequestLog._meta.db_table
+DATE_SUFFIX = '%Y_%m_%d'
+
+
+DEFAULT_PARTITION = f"{TABLE}_default"
+
+
+def partition_name(day):
+    return f"{TABLE}_{day.strftime(DATE_SUFFIX)}"
+
+
+def is_partitioned():
+    """Return True if RequestLog is a partitioned PostgreSQL table."""
+    if connection.vendor != 'postgresql':
+        return False
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT 1 FROM pg_partitioned_table pt "
+            "JOIN pg_class c ON c.oid = pt.partrelid "
+            "WHERE c.relname = %s",
+            [TABLE]
+        )
+        return cursor.fetchone() is not None
+
+
+def ensure_default_partition():
+    quote = connection.ops.quote_name
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"CREATE TABLE IF NOT EXISTS {quote(DEFAULT_PARTITION)} "
+            f"PARTITION OF {quote(TABLE)} DEFAULT"
+        )
+
+
+def oldest_default_day():
+    """Return the UTC day of the oldest row in the DEFAULT partition, or None."""
+    with connection.cursor() as cursor:
+        cursor.execute(f'SELECT MIN("timestamp") FROM {connection.ops.quote_name(DEFAULT_PARTITION)}')
+        oldest = cursor.fetchone()[0]
+    return oldest.date() if oldest else None
+
+
+def ensure_partitions(first_day, last_day):
+    """
+    Create any missing daily partitions from first_day to last_day inclusive.
+
+    Rows already in the DEFAULT partition for a new day are moved into it
+    before it is attached. Returns the number of rows moved. Run inside a
+    transaction.
+    """
+    quote = connection.ops.quote_name
+    moved = 0
+    day = first_day
+    with connection.cursor() as cursor:
+        while day <= last_day:
+            next_day = day + timedelta(days=1)
+            name = partition_name(day)
+            cursor.execute("SELECT to_regclass(%s)", [name])
+            if cursor.fetchone()[0] is None:
+                start = f"'{day.isoformat()} 00:00:00+00'"
+                end = f"'{next_day.isoformat()} 00:00:00+00'"
+                # Identity lives on the parent, so the child must not copy it
+                cursor.execute(
+                    f"CREATE TABLE {quote(name)} (LIKE {quote(TABLE)} INCLUDING DEFAULTS)"
+                )
+                cursor.execute(
+                    f"WITH stray AS ("
+                    f'DELETE FROM {quote(DEFAULT_PARTITION)} WHERE "timestamp" >= {start} AND "timestamp" < {end} '
+                    f"RETURNING *) "
+                    f"INSERT INTO {quote(name)} SELECT * FROM stray"
+                )
+                moved += cursor.rowcount
+                cursor.execute(
+                    f"ALTER TABLE {quote(TABLE)} ATTACH PARTITION {quote(name)} "
+                    f"FOR VALUES FROM ({start}) TO ({end})"
+                )
+            day = next_day
+    return moved
+
+
+def drop_partitions_before(cutoff_day):
+    """Detach and drop every daily partition older than cutoff_day; return their names."""
+    quote = connection.ops.quote_name
+    prefix = f"{TABLE}_"
+    dropped = []
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT c.relname FROM pg_inherits i "
+            "JOIN pg_class c ON c.oid = i.inhrelid "
+            "JOIN pg_class p ON p.oid = i.inhparent "
+            "WHERE p.relname = %s",
+            [TABLE]
+        )
+        for (name,) in cursor.fetchall():
+            try:
+                day = datetime.strptime(name[len(prefix):], DATE_SUFFIX).date()
+            except ValueError:
+                continue
+            if day < cutoff_day:
+                cursor.execute(f"ALTER TABLE {quote(TABLE)} DETACH PARTITION {quote(name)}")
+                cursor.execute(f"DROP TABLE {quote(name)}")
+                dropped.append(name)
+    return dropped
+
+
+def convert_to_partitioned(today, days_ahead):
+    """
+    Rebuild RequestLog as a table partitioned by day on timestamp.
+
+    Existing rows are copied into daily partitions. PostgreSQL requires the
+    partition key in every unique constraint, so the primary key becomes
+    (id, timestamp). Run inside a transaction.
+    """
+    quote = connection.ops.quote_name
+    table = quote(TABLE)
+    legacy = quote(f"{TABLE}_legacy")
+
+    with connection.cursor() as cursor:
+        cursor.execute(f"ALTER TABLE {table} RENAME TO {legacy}")
+        cursor.execute(
+            f"CREATE TABLE {table} (LIKE {legacy} INCLUDING DEFAULTS INCLUDING IDENTITY) "
+            f'PARTITION BY RANGE ("timestamp")'
+        )
+
+        cursor.execute(f'SELECT MIN("timestamp") FROM {legacy}')
+        oldest = cursor.fetchone()[0]
+        first_day = oldest.date() if oldest else today
+        ensure_default_partition()
+        ensure_partitions(first_day, today + timedelta(days=days_ahead))
+
+        cursor.execute(f"INSERT INTO {table} SELECT * FROM {legacy}")
+        cursor.execute(
+            f"SELECT setval(pg_get_serial_sequence(%s, 'id'), COALESCE(MAX(id), 0) + 1, false) FROM {table}",
+            [TABLE]
+        )
+        cursor.execute(f"DROP TABLE {legacy}")
+        # Added only now so the constraint name no longer clashes with the legacy table's
+        cursor.execute(f'ALTER TABLE {table} ADD PRIMARY KEY ("id", "timestamp")')
+
+    # Recreate the model's indexes on the parent; PostgreSQL cascades them to partitions
+    with connection.schema_editor() as editor:
+        for index in RequestLog._meta.indexes:
+            editor.add_index(RequestLog, index)
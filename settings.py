@@ -102,16 +102,22 @@ STATIC_URL = 'static/'
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 # Cache configuration (required for geolocation caching)
+# Shared by web and Celery workers, so geolocation results written by
+# enrich_geo are visible to every process
 CACHES = {
     'default': {
-        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
-        'LOCATION': 'unique-snowflake',
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': os.environ.get('REDIS_URL', 'redis://localhost:6379/0'),
         'TIMEOUT': 86400,  # 24 hours default
+        'OPTIONS': {
+            'socket_timeout': 0.5,
+            'socket_connect_timeout': 0.5,
+        },
     }
 }
 
-# Django-ratelimit settings
-RATELIMIT_USE_CACHE = 'default'
+# Django-ratelimit settings (ip_tracking.ratelimit keeps its counters in
+# IP_TRACKING['REDIS_URL'], so RATELIMIT_USE_CACHE is not used)
 RATELIMIT_ENABLE = True
 
 # Rate limiting configuration
@@ -148,4 +154,17 @@ IP_TRACKING = {
     'GEOLOCATION_TIMEOUT': 5,  # seconds
     'RATE_LIMIT_ANONYMOUS': '5/m',
     'RATE_LIMIT_AUTHENTICATED': '10/m',
+    'TRUSTED_PROXIES': ['127.0.0.1', '::1'],  # reverse proxy IPs whose X-Forwarded-For is trusted; empty ignores the header
+    'REDIS_URL': os.environ.get('REDIS_URL', 'redis://localhost:6379/0'),
+    'REDIS_TIMEOUT': 0.5,  # seconds
+    'BLOCKLIST_CAPACITY': 10000,  # expected number of blocked IPs
+    'BLOCKLIST_ERROR_RATE': 0.001,  # Bloom filter false-positive rate
+    'BLOCKLIST_REFRESH_INTERVAL': 30,  # seconds between Bloom filter rebuilds
+    'BLOCKLIST_DECISION_CACHE_SIZE': 50000,
+    'BLOCKLIST_DECISION_CACHE_TTL': 60,  # seconds a per-IP block decision is reused
+    'REQUEST_LOG_RETENTION_DAYS': 30,  # older request logs (or partitions) are removed daily
+    'REQUEST_LOG_PARTITION_DAYS_AHEAD': 7,  # future daily partitions kept ready
+    'LOG_QUEUE_SIZE': 10000,  # pending RequestLog rows before writes go synchronous
+    'LOG_BATCH_SIZE': 500,
+    'LOG_FLUSH_INTERVAL': 1.0,  # seconds
 }